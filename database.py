@@ -1,90 +1,305 @@
 import sqlite3
-from passlib.hash import bcrypt
+import bcrypt
+from cachetools import TTLCache
+from contextlib import contextmanager
+from functools import lru_cache, wraps
 import datetime
+import hashlib
+import hmac
+import os
+import queue
+import threading
 
 DB_NAME = "users.db"
+READ_POOL_SIZE = 4
+BCRYPT_ROUNDS = 10
+USER_CACHE_SIZE = 2048
+BCRYPT_MAX_PASSWORD_BYTES = 72
+VERIFY_CACHE_SIZE = 4096
+VERIFY_CACHE_TTL = 15  # seconds
+# Secret key for the fast pre-check hash stored next to each bcrypt hash. Without it
+# the pre-check is off. Enabling it trades offline-cracking resistance for speed:
+# anyone holding both the database and the pepper can test password guesses at
+# blake2b speed instead of bcrypt speed. Each fast hash is tagged with an id derived
+# from the pepper; after a pepper change, rows with the old tag skip the pre-check
+# and go straight to bcrypt until their password is next set.
+PASSWORD_PEPPER = os.getenv("PASSWORD_PEPPER", "").encode()
+PEPPER_ID_SIZE = 8
+
+# Hot-path SQL kept as module constants so every call hands sqlite3 the exact
+# same string and hits the connection's prepared-statement cache.
+_SQL_INSERT_USER = "INSERT INTO users (username, email, password, fast_hash) VALUES (?, ?, ?, ?)"
+_SQL_INSERT_USER_IF_NEW = "INSERT OR IGNORE INTO users (username, email, password, fast_hash) VALUES (?, ?, ?, ?)"
+_SQL_SELECT_PASSWORD = "SELECT password, fast_hash FROM users WHERE username = ?"
+_SQL_SELECT_USER_BY_EMAIL = "SELECT id, username, email FROM users WHERE email = ?"
+_SQL_SELECT_USER_BY_USERNAME = "SELECT id, username, email FROM users WHERE username = ?"
+_SQL_SELECT_USER_BY_EMAIL_OR_USERNAME = (
+    # An email match wins over a username match, as in the old two-query lookup.
+    "SELECT id, username, email FROM users WHERE email = ? OR username = ? ORDER BY email = ? DESC LIMIT 1"
+)
+_SQL_UPDATE_PASSWORD = "UPDATE users SET password = ?, fast_hash = ? WHERE email = ?"
+_SQL_EXPIRE_TOKENS_FOR_EMAIL = "UPDATE password_reset_tokens SET used = 1 WHERE email = ? AND used = 0"
+_SQL_INSERT_TOKEN = "INSERT INTO password_reset_tokens (email, token, expires_at) VALUES (?, ?, ?)"
+_SQL_SELECT_TOKEN = "SELECT email, expires_at, used FROM password_reset_tokens WHERE token = ?"
+_SQL_INVALIDATE_TOKEN = "UPDATE password_reset_tokens SET used = 1 WHERE token = ?"
+
+# Per-connection tuning. journal_mode=WAL is persistent on the file, the rest
+# have to be re-issued every time a connection is opened.
+def _configure(conn: sqlite3.Connection) -> sqlite3.Connection:
+    conn.executescript("""
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-64000;
+    PRAGMA busy_timeout=5000;
+    """)
+    return conn
+
+def _connect(read_only: bool = False) -> sqlite3.Connection:
+    # isolation_level=None puts the connection in autocommit mode; multi-statement
+    # writes issue their own BEGIN/COMMIT.
+    conn = _configure(sqlite3.connect(DB_NAME, check_same_thread=False, isolation_level=None,
+                                        cached_statements=128))
+    if read_only:
+        conn.execute("PRAGMA query_only=1")
+    return conn
+
+# One long-lived read/write connection (SQLite only allows a single writer anyway)
+# plus a small pool of read-only connections, which don't block each other under WAL.
+_write_conn = _connect()
+_write_lock = threading.Lock()
+_read_pool: queue.Queue = queue.Queue(maxsize=READ_POOL_SIZE)
+for _ in range(READ_POOL_SIZE):
+    _read_pool.put(_connect(read_only=True))
+
+@contextmanager
+def _writer():
+    with _write_lock:
+        yield _write_conn
+
+@contextmanager
+def _reader():
+    conn = _read_pool.get()
+    try:
+        yield conn
+    finally:
+        _read_pool.put(conn)
+
+# Passwords are hashed with the bcrypt package directly rather than through passlib.
+# Hashes are the same "$2b$..." values passlib stored, kept as raw bytes in a BLOB
+# column, and the cost is encoded in each hash, so existing cost-12 hashes still verify.
+def _password_bytes(password: str) -> bytes:
+    # bcrypt only uses the first 72 bytes; passlib truncated silently, newer bcrypt raises.
+    return password.encode()[:BCRYPT_MAX_PASSWORD_BYTES]
+
+def _hash_password(password: str) -> bytes:
+    return bcrypt.hashpw(_password_bytes(password), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+
+def _check_password(password: str, hashed_password) -> bool:
+    # TEXT hashes can still be written by a process running older code during a deploy
+    if isinstance(hashed_password, str):
+        hashed_password = hashed_password.encode()
+    return bcrypt.checkpw(_password_bytes(password), hashed_password)
+
+_pepper_id = None
+if PASSWORD_PEPPER:
+    _pepper_id = hashlib.blake2b(b"fast_hash pepper id", key=PASSWORD_PEPPER, digest_size=PEPPER_ID_SIZE).digest()
+
+def _fast_hash(password: str, hashed_password):
+    """
+    Pepper id followed by a keyed blake2b of the password, salted with the bcrypt
+    hash's own salt. Lets verify_user reject a wrong password in microseconds
+    before running bcrypt. Returns None when no PASSWORD_PEPPER is configured.
+    """
+    if not PASSWORD_PEPPER:
+        return None
+    if isinstance(hashed_password, str):
+        hashed_password = hashed_password.encode()
+    # "$2b$NN$" + 22-character salt
+    salt = hashed_password[:29]
+    return _pepper_id + hashlib.blake2b(salt + _password_bytes(password), key=PASSWORD_PEPPER, digest_size=16).digest()
+
+def _fast_hash_rejects(password: str, hashed_password, fast_hash) -> bool:
+    """
+    True when the stored fast hash proves the password wrong. Rows without a fast
+    hash, or with one made under a different pepper, are left to bcrypt.
+    """
+    if fast_hash is None or _pepper_id is None or fast_hash[:PEPPER_ID_SIZE] != _pepper_id:
+        return False
+    return not hmac.compare_digest(fast_hash, _fast_hash(password, hashed_password))
+
+# Short-lived cache of verify_user results, so a retried login doesn't pay for
+# bcrypt again. Keys hold a keyed hash of the password, never the password itself
+# (the key is random per process), plus the stored bcrypt hash: a password change
+# in any process yields a new key, so stale results are never looked up again.
+_verify_cache = TTLCache(maxsize=VERIFY_CACHE_SIZE, ttl=VERIFY_CACHE_TTL)
+_verify_cache_lock = threading.Lock()
+_verify_cache_key = os.urandom(16)
+
+def _verify_cache_entry(username: str, hashed_password, password: str):
+    digest = hashlib.blake2b(password.encode(), key=_verify_cache_key, digest_size=16).digest()
+    return (username, hashed_password, digest)
+
+def _cache_hits(func):
+    """
+    LRU-caches a user lookup, but only when a user was found.
+    Users are never deleted or renamed, so a hit stays valid; a miss is not
+    cached because another worker process may create that user at any time.
+    """
+    @lru_cache(maxsize=USER_CACHE_SIZE)
+    def cached(key):
+        user = func(key)
+        if user is None:
+            raise LookupError(key)  # exceptions are not memoized by lru_cache
+        return user
+
+    @wraps(func)
+    def wrapper(key):
+        try:
+            return dict(cached(key))
+        except LookupError:
+            return None
+
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+def _clear_user_caches():
+    get_user_by_email.cache_clear()
+    get_user_by_username.cache_clear()
+    get_user_by_email_or_username.cache_clear()
 
 # Create tables if they don't exist
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    # Create users table
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE,
-        email TEXT UNIQUE,
-        password TEXT
-    )
-    """)
-    # Create password_reset_tokens table (kept for compatibility, but not used in new direct reset flow)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS password_reset_tokens (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        email TEXT NOT NULL,
-        token TEXT UNIQUE NOT NULL,
-        expires_at TIMESTAMP NOT NULL,
-        used BOOLEAN DEFAULT 0
-    )
-    """)
-    conn.commit()
-    conn.close()
+    with _writer() as conn:
+        # Every worker runs this at import; IMMEDIATE takes the write lock up front so
+        # the column check and migrations below run in one worker at a time.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.cursor()
+            # Create users table
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE,
+                email TEXT UNIQUE,
+                password BLOB,
+                fast_hash BLOB
+            )
+            """)
+            # Databases created before fast_hash existed get the column added; rows
+            # without a fast hash are always checked with bcrypt.
+            columns = {row[1] for row in cursor.execute("PRAGMA table_info(users)")}
+            if "fast_hash" not in columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN fast_hash BLOB")
+            # Hashes used to be stored as TEXT; convert any left over to BLOB
+            cursor.execute("UPDATE users SET password = CAST(password AS BLOB) WHERE typeof(password) = 'text'")
+            # Create password_reset_tokens table (kept for compatibility, but not used in new direct reset flow)
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS password_reset_tokens (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email TEXT NOT NULL,
+                token TEXT UNIQUE NOT NULL,
+                expires_at TIMESTAMP NOT NULL,
+                used BOOLEAN DEFAULT 0
+            )
+            """)
+            # Partial index over unused tokens, for invalidating an email's open tokens
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_prt_email_active ON password_reset_tokens(email) WHERE used = 0")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
 
 # Create a new user
 def create_user(username: str, email: str, password: str) -> bool:
-    init_db() # Ensure tables are created
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    try:
-        hashed_password = bcrypt.hash(password)
-        cursor.execute("INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
-                       (username, email, hashed_password))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        # This error occurs if username or email is not unique
-        return False
-    finally:
-        conn.close()
+    hashed_password = _hash_password(password)
+    fast_hash = _fast_hash(password, hashed_password)
+    with _writer() as conn:
+        try:
+            conn.execute(_SQL_INSERT_USER, (username, email, hashed_password, fast_hash))
+        except sqlite3.IntegrityError:
+            # This error occurs if username or email is not unique
+            return False
+    _clear_user_caches()
+    return True
+
+def create_users_bulk(rows) -> int:
+    """
+    Creates many users in a single transaction, so the batch costs one commit.
+    `rows` is an iterable of (username, email, password) tuples.
+    Rows whose username or email already exists are skipped.
+    Returns the number of users created.
+    """
+    hashed_rows = []
+    for username, email, password in rows:
+        hashed_password = _hash_password(password)
+        hashed_rows.append((username, email, hashed_password, _fast_hash(password, hashed_password)))
+    with _writer() as conn:
+        try:
+            conn.execute("BEGIN")
+            cursor = conn.executemany(_SQL_INSERT_USER_IF_NEW, hashed_rows)
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+    _clear_user_caches()
+    return cursor.rowcount
 
 # Verify existing user credentials
 def verify_user(username: str, password: str) -> bool:
-    init_db() # Ensure tables are created
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT password FROM users WHERE username = ?", (username,))
-    row = cursor.fetchone()
-    conn.close()
-    if row and bcrypt.verify(password, row[0]):
-        return True
-    return False
+    with _reader() as conn:
+        row = conn.execute(_SQL_SELECT_PASSWORD, (username,)).fetchone()
+    if row is None:
+        return False
+    hashed_password, fast_hash = row
+
+    entry = _verify_cache_entry(username, hashed_password, password)
+    with _verify_cache_lock:
+        cached = _verify_cache.get(entry)
+    if cached is not None:
+        return cached
+
+    if _fast_hash_rejects(password, hashed_password, fast_hash):
+        verified = False
+    else:
+        verified = _check_password(password, hashed_password)
+    with _verify_cache_lock:
+        _verify_cache[entry] = verified
+    return verified
 
+@_cache_hits
 def get_user_by_email(email: str):
     """
     Retrieves user data by email.
     Returns a dictionary with user info if found, None otherwise.
     """
-    init_db() # Ensure tables are created
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, username, email FROM users WHERE email = ?", (email,))
-    row = cursor.fetchone()
-    conn.close()
+    with _reader() as conn:
+        row = conn.execute(_SQL_SELECT_USER_BY_EMAIL, (email,)).fetchone()
     if row:
         return {"id": row[0], "username": row[1], "email": row[2]}
     return None
 
+@_cache_hits
 def get_user_by_username(username: str):
     """
     Retrieves user data by username.
     Returns a dictionary with user info if found, None otherwise.
     """
-    init_db() # Ensure tables are created
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, username, email FROM users WHERE username = ?", (username,))
-    row = cursor.fetchone()
-    conn.close()
+    with _reader() as conn:
+        row = conn.execute(_SQL_SELECT_USER_BY_USERNAME, (username,)).fetchone()
+    if row:
+        return {"id": row[0], "username": row[1], "email": row[2]}
+    return None
+
+@_cache_hits
+def get_user_by_email_or_username(identifier: str):
+    """
+    Retrieves user data by email or username in a single query.
+    Returns a dictionary with user info if found, None otherwise.
+    """
+    with _reader() as conn:
+        row = conn.execute(_SQL_SELECT_USER_BY_EMAIL_OR_USERNAME, (identifier, identifier, identifier)).fetchone()
     if row:
         return {"id": row[0], "username": row[1], "email": row[2]}
     return None
@@ -94,14 +309,12 @@ def update_user_password(email: str, new_password: str) -> bool:
     Updates a user's password in the database.
     Returns True on success, False on failure (e.g., user not found).
     """
-    init_db() # Ensure tables are created
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    hashed_password = bcrypt.hash(new_password)
-    cursor.execute("UPDATE users SET password = ? WHERE email = ?", (hashed_password, email))
-    conn.commit()
-    success = cursor.rowcount > 0
-    conn.close()
+    hashed_password = _hash_password(new_password)
+    fast_hash = _fast_hash(new_password, hashed_password)
+    with _writer() as conn:
+        cursor = conn.execute(_SQL_UPDATE_PASSWORD, (hashed_password, fast_hash, email))
+        success = cursor.rowcount > 0
+    _clear_user_caches()
     return success
 
 # --- Password Reset Token Management Functions (These are no longer actively used for direct reset) ---
@@ -111,23 +324,21 @@ def save_password_reset_token(email: str, token: str, expires_at: datetime.datet
     Saves a password reset token to the database.
     If a token already exists for the email, it will be updated (or replaced).
     """
-    init_db() # Ensure tables are created
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    try:
-        # First, invalidate any existing tokens for this email
-        cursor.execute("UPDATE password_reset_tokens SET used = 1 WHERE email = ? AND used = 0", (email,))
-
-        # Insert the new token
-        cursor.execute("INSERT INTO password_reset_tokens (email, token, expires_at) VALUES (?, ?, ?)",
-                       (email, token, expires_at))
-        conn.commit()
-        return True
-    except Exception as e:
-        print(f"Error saving password reset token: {e}")
-        return False
-    finally:
-        conn.close()
+    with _writer() as conn:
+        try:
+            conn.execute("BEGIN")
+            # First, invalidate any existing tokens for this email
+            conn.execute(_SQL_EXPIRE_TOKENS_FOR_EMAIL, (email,))
+
+            # Insert the new token
+            conn.execute(_SQL_INSERT_TOKEN, (email, token, expires_at))
+            conn.execute("COMMIT")
+            return True
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            print(f"Error saving password reset token: {e}")
+            return False
 
 def verify_password_reset_token(token: str) -> str | None:
     """
@@ -135,12 +346,8 @@ def verify_password_reset_token(token: str) -> str | None:
     Returns the user's email if the token is valid and not expired, None otherwise.
     Should also check if the token has already been used.
     """
-    init_db() # Ensure tables are created
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT email, expires_at, used FROM password_reset_tokens WHERE token = ?", (token,))
-    row = cursor.fetchone()
-    conn.close()
+    with _reader() as conn:
+        row = conn.execute(_SQL_SELECT_TOKEN, (token,)).fetchone()
 
     if row:
         email, expires_at_str, used = row
@@ -154,14 +361,9 @@ def invalidate_token(token: str) -> bool:
     """
     Invalidates a password reset token after it has been used.
     """
-    init_db() # Ensure tables are created
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE password_reset_tokens SET used = 1 WHERE token = ?", (token,))
-    conn.commit()
-    success = cursor.rowcount > 0
-    conn.close()
-    return success
+    with _writer() as conn:
+        cursor = conn.execute(_SQL_INVALIDATE_TOKEN, (token,))
+        return cursor.rowcount > 0
 
 # Initialize the database when the script starts
 init_db()
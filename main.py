@@ -1,40 +1,101 @@
 from fastapi import FastAPI, Request, Form, UploadFile, File, Query
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, JSONResponse, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
+from jinja2 import FileSystemBytecodeCache
+from functools import lru_cache
 # Assuming these functions exist in your database.py and handle user/token operations
-from database import create_user, verify_user, get_user_by_email, get_user_by_username, update_user_password
+from database import create_user, verify_user, get_user_by_email_or_username, update_user_password
+import asyncio
 import os
-import subprocess
+import re
 import uuid
 
 app = FastAPI()
 templates = Jinja2Templates(directory="templates")
+# Compiled templates are kept on disk so new workers skip re-compiling them. With no
+# directory given, Jinja uses a private per-user temp directory (mode 0700) and
+# refuses one owned by someone else.
+templates.env.bytecode_cache = FileSystemBytecodeCache()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 UPLOAD_DIR = "uploads"
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+CONVERT_CONCURRENCY = 2
+UNOSERVER_HOST = "127.0.0.1"
+UNOSERVER_PORT = int(os.getenv("UNOSERVER_PORT", "2003"))
+# When set (e.g. "/protected/"), downloads are handed to nginx via X-Accel-Redirect
+# so the file is streamed by the proxy instead of through Python. nginx needs a
+# matching `location /protected/ { internal; alias /app/uploads/; }`.
+X_ACCEL_PREFIX = os.getenv("X_ACCEL_PREFIX")
+# file_ids are generated by /convert; anything else is rejected without touching the disk.
+# The dashed form is what older uploads were named with.
+FILE_ID_RE = re.compile(r"[0-9a-f]{32}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+def upload_relpath(file_id: str, ext: str) -> str:
+    """
+    Path of an upload relative to UPLOAD_DIR. Files are sharded into
+    subdirectories by the first two hex characters of their id so no single
+    directory grows unbounded; older dashed ids live flat in UPLOAD_DIR.
+    """
+    if "-" in file_id:
+        return file_id + ext
+    return os.path.join(file_id[:2], file_id + ext)
+
+# --- Persistent LibreOffice listener ---
+# unoserver keeps one headless soffice running and converts over UNO, so a
+# request doesn't pay LibreOffice's cold start. It runs as its own supervised
+# process (see start.sh), shared by all workers. soffice is not thread-safe,
+# hence the semaphore around conversions.
+_convert_semaphore = asyncio.Semaphore(CONVERT_CONCURRENCY)
+
+async def _unoserver_available() -> bool:
+    # unoserver may still be starting or restarting, so check it is listening
+    # before each conversion; the connect is negligible next to the conversion.
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(UNOSERVER_HOST, UNOSERVER_PORT), timeout=1)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    await writer.wait_closed()
+    return True
+
+async def _convert_command(input_path: str, output_path: str) -> list[str]:
+    if await _unoserver_available():
+        return ["unoconvert", "--host", UNOSERVER_HOST, "--port", str(UNOSERVER_PORT),
+                "--convert-to", "pdf", input_path, output_path]
+    return ["libreoffice", "--headless", "--convert-to", "pdf", input_path, "--outdir", os.path.dirname(output_path)]
+
 # --- PDF conversion endpoint ---
 @app.post("/convert")
 async def convert_to_pdf(file: UploadFile = File(...)):
-    file_id = str(uuid.uuid4())
-    input_path = os.path.join(UPLOAD_DIR, file_id + ".docx")
-    output_path = os.path.join(UPLOAD_DIR, file_id + ".pdf")
+    file_id = uuid.uuid4().hex
+    os.makedirs(os.path.join(UPLOAD_DIR, file_id[:2]), exist_ok=True)
+    input_path = os.path.join(UPLOAD_DIR, upload_relpath(file_id, ".docx"))
+    output_path = os.path.join(UPLOAD_DIR, upload_relpath(file_id, ".pdf"))
 
+    # Stream the upload to disk so peak memory is one chunk, not the whole file
     with open(input_path, "wb") as f:
-        f.write(await file.read())
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            f.write(chunk)
 
-    # Ensure libreoffice is installed and accessible in your environment
+    # Ensure unoserver (or at least libreoffice) is installed and accessible in your environment
     try:
-        subprocess.run(["libreoffice", "--headless", "--convert-to", "pdf", input_path, "--outdir", UPLOAD_DIR], check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"LibreOffice conversion failed: {e}")
-        return JSONResponse({"status": "failed", "message": "PDF conversion failed."}, status_code=500)
+        async with _convert_semaphore:
+            proc = await asyncio.create_subprocess_exec(*await _convert_command(input_path, output_path),
+                                                        stdout=asyncio.subprocess.DEVNULL,
+                                                        stderr=asyncio.subprocess.PIPE)
+            _, err = await proc.communicate()
+        if proc.returncode != 0:
+            print(f"LibreOffice conversion failed (exit {proc.returncode}): {err.decode(errors='replace')}")
+            return JSONResponse({"status": "failed", "message": "PDF conversion failed."}, status_code=500)
     except FileNotFoundError:
         print("LibreOffice command not found. Please ensure LibreOffice is installed and in your PATH.")
         return JSONResponse({"status": "failed", "message": "Server error: PDF converter not found."}, status_code=500)
 
+    # libreoffice can exit 0 without writing anything, so check the output is there
     if os.path.exists(output_path):
         return JSONResponse({"status": "completed", "file_id": file_id})
     else:
@@ -43,19 +104,42 @@ async def convert_to_pdf(file: UploadFile = File(...)):
 
 @app.get("/download/{file_id}")
 async def download_pdf(file_id: str):
-    pdf_path = os.path.join(UPLOAD_DIR, file_id + ".pdf")
-    if os.path.exists(pdf_path):
-        return FileResponse(pdf_path, filename="converted.pdf")
-    return JSONResponse({"error": "File not found"}, status_code=404)
+    if not FILE_ID_RE.fullmatch(file_id):
+        return JSONResponse({"error": "File not found"}, status_code=404)
+    if X_ACCEL_PREFIX:
+        # nginx answers 404 itself if the file is missing
+        return Response(media_type="application/pdf", headers={
+            "X-Accel-Redirect": X_ACCEL_PREFIX.rstrip("/") + "/" + upload_relpath(file_id, ".pdf"),
+            "Content-Disposition": 'attachment; filename="converted.pdf"',
+        })
+    pdf_path = os.path.join(UPLOAD_DIR, upload_relpath(file_id, ".pdf"))
+    # Stat once and hand the result to FileResponse so it doesn't stat again
+    try:
+        stat_result = os.stat(pdf_path)
+    except FileNotFoundError:
+        return JSONResponse({"error": "File not found"}, status_code=404)
+    return FileResponse(pdf_path, media_type="application/pdf", filename="converted.pdf", stat_result=stat_result)
+
+# --- Cached pages ---
+# Form pages without a message or error render the same HTML every time, so
+# render them once per worker and let intermediaries cache them briefly.
+STATIC_PAGE_CACHE_CONTROL = "public, max-age=60"
+
+@lru_cache(maxsize=None)
+def _render_static_page(template_name: str) -> str:
+    return templates.get_template(template_name).render()
+
+def static_page(template_name: str) -> HTMLResponse:
+    return HTMLResponse(_render_static_page(template_name), headers={"Cache-Control": STATIC_PAGE_CACHE_CONTROL})
 
 # --- Registration ---
 @app.get("/register", response_class=HTMLResponse)
 async def register_form(request: Request):
-    return templates.TemplateResponse("register.html", {"request": request})
+    return static_page("register.html")
 
 @app.post("/register")
 async def register_user(request: Request, username: str = Form(...), email: str = Form(...), password: str = Form(...)):
-    if create_user(username, email, password): # Assumes create_user handles unique username/email
+    if await run_in_threadpool(create_user, username, email, password): # Assumes create_user handles unique username/email
         return RedirectResponse("/login?message=registration_success", status_code=303)
     return templates.TemplateResponse("register.html", {"request": request, "error": "Username or Email already exists"})
 
@@ -64,11 +148,13 @@ async def register_user(request: Request, username: str = Form(...), email: str
 async def login_form(request: Request):
     message = request.query_params.get("message")
     error = request.query_params.get("error")
+    if message is None and error is None:
+        return static_page("login.html")
     return templates.TemplateResponse("login.html", {"request": request, "message": message, "error": error})
 
 @app.post("/login", response_class=HTMLResponse)
 async def login(request: Request, username: str = Form(...), password: str = Form(...)):
-    if verify_user(username, password):
+    if await run_in_threadpool(verify_user, username, password):
         return RedirectResponse(f"/dashboard?username={username}", status_code=303)
     return templates.TemplateResponse("login.html", {"request": request, "error": "Invalid username or password"})
 
@@ -76,6 +162,8 @@ async def login(request: Request, username: str = Form(...), password: str = For
 @app.get("/forgot_password", response_class=HTMLResponse)
 async def forgot_password_page(request: Request):
     error = request.query_params.get("error")
+    if error is None:
+        return static_page("forgot_password.html")
     return templates.TemplateResponse("forgot_password.html", {"request": request, "error": error})
 
 @app.post("/reset_password_direct")
@@ -83,12 +171,10 @@ async def reset_password_direct(request: Request, username_or_email: str = Form(
     if new_password != confirm_new_password:
         return templates.TemplateResponse("forgot_password.html", {"request": request, "error": "Passwords do not match."})
 
-    user = get_user_by_email(username_or_email)
-    if not user:
-        user = get_user_by_username(username_or_email)
+    user = get_user_by_email_or_username(username_or_email)
 
     if user:
-        if update_user_password(user["email"], new_password):
+        if await run_in_threadpool(update_user_password, user["email"], new_password):
             return RedirectResponse("/login?message=password_reset_success", status_code=303)
         else:
             return templates.TemplateResponse("forgot_password.html", {"request": request, "error": "Failed to reset password. Please try again."})
@@ -98,7 +184,7 @@ async def reset_password_direct(request: Request, username_or_email: str = Form(
 # --- Root and dashboard ---
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
-    return templates.TemplateResponse("login.html", {"request": request})
+    return static_page("login.html")
 
 @app.get("/dashboard", response_class=HTMLResponse)
 async def dashboard(request: Request, username: str = Query("Guest")):
@@ -0,0 +1,20 @@
+#!/bin/sh
+# Start the PDF converter and the web app in one container.
+
+# --- unoserver ---
+# One long-lived headless LibreOffice shared by every uvicorn worker.
+# Restarted if it exits; main.py falls back to one-shot libreoffice while it is down.
+(
+    while true; do
+        unoserver --interface 127.0.0.1 --port "${UNOSERVER_PORT:-2003}"
+        echo "unoserver exited with status $?, restarting..."
+        sleep 1
+    done
+) &
+
+# --- FastAPI app ---
+# uvicorn main:app: Specifies that 'app' is the FastAPI instance in 'main.py'.
+# --host 0.0.0.0: Makes the server accessible from outside the container.
+# --port 8000: Specifies the port to listen on.
+# --workers 4: Runs several worker processes so password hashing can use multiple cores.
+exec uvicorn main:app --host 0.0.0.0 --port 8000 --workers 4